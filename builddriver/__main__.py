@@ -2,11 +2,45 @@ import sys
 import builddriver
 
 
+def _report_watch(session, handle):
+    retcode = handle.returncode()
+    if retcode == 0:
+        msg = 'Build #{} SUCCEED in {} seconds\n'
+    else:
+        msg = 'Build #{} FAILED in {} seconds\n'
+    sys.stderr.write(msg.format(session.iteration(),
+                                handle.build_duration().total_seconds()))
+    sys.stderr.write('Number of warnings: {}\n'.format(session.warnings_no()))
+    sys.stderr.write('Number of errors: {}\n'.format(session.errors_no()))
+    for warn in session.warnings():
+        print(warn)
+    for error in session.errors():
+        print(error)
+    sys.stderr.write('For full log, please open: {}\n'.format(handle.tmp_name()))
+    sys.stderr.write('Waiting for changes, press Ctrl-C to exit\n')
+
+
+def main_watch(args):
+    cmd = " ".join(args)
+    sys.stderr.write('builddriver watching, executing: \'{}\'\n'.format(cmd))
+    try:
+        builddriver.watch(cmd, callback=_report_watch)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
 def main():
     if len(sys.argv) < 2:
         sys.stderr.write('command missing, exiting\n')
         sys.exit(1)
 
+    if sys.argv[1] in ('-w', '--watch'):
+        if len(sys.argv) < 3:
+            sys.stderr.write('command missing, exiting\n')
+            sys.exit(1)
+        return main_watch(sys.argv[2:])
+
     cmd = " ".join(sys.argv[1:])
     sys.stderr.write('builddriver executing: \'{}\'\n'.format(cmd))
     ret = builddriver.execute(cmd)
@@ -3,18 +3,30 @@
 
 import os
 import re
+import errno
 import sys
 import glob
+import time
 import types
+import struct
+import select
+import ctypes
+import ctypes.util
+import fnmatch
+import itertools
 import subprocess
 import tempfile
 import datetime
 
 from dataclasses import dataclass
+from dataclasses import field
+from typing import Callable
+from typing import Iterable
 from typing import Iterator
 from typing import List
 from typing import Dict
 from typing import Optional
+from typing import Set
 
 LOG_PREFIX = 'build-'
 LOG_SUFFIX = '.log'
@@ -39,6 +51,12 @@ class WarningErrorEntry:
     severity: str
     message: str
     column: int = None
+    # directory make was in (make -C, recursive make), path is
+    # relative to it. None if make did not tell us
+    directory: str = field(default=None, compare=False, repr=False)
+    # compilation units which included the file, empty if
+    # the diagnostic is not within an included file
+    units: Set[str] = field(default_factory=set, compare=False, repr=False)
 
 
 class ExecutionHandle:
@@ -286,6 +304,28 @@ RE_LD_WITH_FILE_LINE_NO = re.compile(
 RE_LD_WITH_FILE = re.compile('^(.*):.+:\\s+((?:undefined reference to|could not read symbols).+)$')
 # (.text+0x20): undefined reference to `main'
 RE_LD_WITHOUT_FILE = re.compile('^(.*):\\s+((?:undefined reference to|could not read symbols).+)$')
+RE_LD_MESSAGE = re.compile('^(?:undefined reference to|could not read symbols)')
+
+# make: Entering directory '/home/me/dev/foo'
+# make[1]: Leaving directory '/home/me/dev/foo/lib'
+RE_MAKE_DIRECTORY = re.compile("^\\S*make(?:\\[\\d+\\])?: (Entering|Leaving) directory [`'](.*)'$")
+
+# gcc, innermost first, the unit is the last line:
+# In file included from z.h:1,
+#                  from a.c:1:
+# clang, outermost first, the unit is the first line:
+# In file included from a.c:1:
+# In file included from ./z.h:1:
+RE_INCLUDED_FROM = re.compile('^(In file included|\\s+) from (.+?):\\d+(?::\\d+)?[:,]$')
+
+
+def _is_linker_entry(entry: WarningErrorEntry) -> bool:
+    '''
+    True if the entry was reported by the linker, not by
+    the compiler. The source path (if any) of such errors
+    is not the unit which must be fixed.
+    '''
+    return bool(RE_LD_MESSAGE.match(entry.message))
 
 
 class GccOutputParser:
@@ -302,6 +342,11 @@ class GccOutputParser:
         self._unmatched.enabled = kwargs.get('record_unmatched', False)
         self._unmatched.db = list()
         self._unmatched.no = 0
+        # make directory stack, to resolve relative paths
+        self._directories = list()
+        # unit of the last include chain, see RE_INCLUDED_FROM
+        self._include_unit = None
+        self._include_chain = False
 
     def unmatched(self) -> List[str]:
         """
@@ -328,6 +373,19 @@ class GccOutputParser:
         for line in lines.splitlines():
             line = line.rstrip()
             self._parsed_lines += 1
+            if line.startswith(('In file included from', ' ')):
+                m = RE_INCLUDED_FROM.match(line)
+                if m:
+                    self._process_included_from(m)
+                    self._process_trace_unmachted(line)
+                    continue
+            self._include_chain = False
+            m = RE_MAKE_DIRECTORY.match(line)
+            if m:
+                self._process_make_directory(m)
+                # still not a gcc/clang line, trace it
+                self._process_trace_unmachted(line)
+                continue
             m = RE_GCC_WITH_COLUMN.match(line)
             if m:
                 self._process_gcc_with_column(m)
@@ -381,6 +439,27 @@ class GccOutputParser:
     # just an alias, call what you want
     feed = record
 
+    def discard(self, predicate: Callable[[WarningErrorEntry], bool]) -> None:
+        '''
+        Remove all warnings and errors where predicate(entry)
+        returns True, counters are adjusted accordingly.
+        Used to forget diagnostics of compilation units which
+        are going to be rebuilt.
+        '''
+        self._db_warnings = [e for e in self._db_warnings if not predicate(e)]
+        self._db_errors = [e for e in self._db_errors if not predicate(e)]
+        self._warnings_no = len(self._db_warnings)
+        self._errors_no = len(self._db_errors)
+
+    def absorb(self, entries: Iterable[WarningErrorEntry]) -> None:
+        '''
+        Add already parsed entries (e.g. from another parser
+        instance) to this parser. Same rules as for parsed
+        lines apply: duplicated warnings are ignored.
+        '''
+        for entry in entries:
+            self._process_new_entry(entry)
+
     @staticmethod
     def _error_warning_selector(string):
         if 'error' in string:
@@ -397,11 +476,36 @@ class GccOutputParser:
         else:
             self._matched_unknown_no += 1
 
+    def _process_included_from(self, regex_match):
+        if not (self._include_chain and regex_match.group(1) == 'In file included'):
+            self._include_unit = regex_match.group(2)
+        self._include_chain = True
+
+    def _process_make_directory(self, regex_match):
+        self._include_unit = None
+        if regex_match.group(1) == 'Entering':
+            self._directories.append(regex_match.group(2))
+        elif self._directories:
+            self._directories.pop()
+
     def _process_new_entry(self, entry):
+        if self._directories and entry.directory is None:
+            entry.directory = self._directories[-1]
+        if self._include_unit is not None:
+            if entry.path == self._include_unit:
+                # back in the unit itself
+                self._include_unit = None
+            else:
+                entry.units.add(self._include_unit)
         if entry.severity == 'warning':
-            if not entry in self._db_warnings:
+            try:
+                known = self._db_warnings.index(entry)
+            except ValueError:
                 self._db_warnings.append(entry)
                 self._account_severity(entry)
+            else:
+                # same header warning, included by another unit
+                self._db_warnings[known].units.update(entry.units)
         if entry.severity == 'error':
             self._db_errors.append(entry)
             self._account_severity(entry)
@@ -466,6 +570,439 @@ class GccOutputParser:
         self._unmatched.db.append(line)
 
 
+# files which trigger a rebuild in watch mode, everything else
+# (object files, binaries, logs) is ignored. Otherwise the build
+# output itself would trigger the next rebuild.
+WATCH_PATTERNS = ('*.c', '*.h', '*.cc', '*.cpp', '*.cxx', '*.hh', '*.hpp',
+                  '*.hxx', '*.S', '*.s', 'Makefile', 'makefile', 'GNUmakefile',
+                  '*.mk', 'Kbuild', 'Kconfig', 'CMakeLists.txt', '*.cmake')
+
+# changed files matching these are compiled on their own, everything
+# else (headers, makefiles) may trigger a rebuild of other units
+UNIT_PATTERNS = ('*.c', '*.cc', '*.cpp', '*.cxx', '*.S', '*.s')
+OBJECT_PATTERNS = ('*.o', '*.obj', '*.lo')
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE)
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _watch_dirs(root):
+    for dirpath, dirnames, _ in os.walk(root):
+        # .git, .cache and friends are never part of the build
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        yield dirpath
+
+
+def _watch_match(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def _watch_scan(root, patterns):
+    # path -> mtime of all files matching patterns below root
+    snapshot = dict()
+    for dirpath in _watch_dirs(root):
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            continue
+        for name in names:
+            if not _watch_match(name, patterns):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                snapshot[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+    return snapshot
+
+
+def _object_key(path):
+    # foo/bar.c and foo/bar.o share the same key
+    return os.path.join(os.path.dirname(path),
+                        os.path.splitext(os.path.basename(path))[0])
+
+
+def _is_changed(path, changed):
+    return any(path == c or path.startswith(c + os.sep) for c in changed)
+
+
+class _PollingWatcher:
+    '''
+    Stdlib only fallback: rescans the tree every interval
+    seconds and compares modification times.
+    '''
+
+    def __init__(self, root, patterns, interval=0.5):
+        self._root = root
+        self._patterns = patterns
+        self._interval = interval
+        self._snapshot = _watch_scan(root, patterns)
+
+    def _rescan(self):
+        snapshot = _watch_scan(self._root, self._patterns)
+        changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is None:
+                time.sleep(self._interval)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return set()
+                time.sleep(min(self._interval, remaining))
+            changed = self._rescan()
+            if changed:
+                return changed
+
+    def drain(self) -> Set[str]:
+        # everything changed since the last scan, without waiting
+        return self._rescan()
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher:
+    '''
+    Linux inotify(7) via ctypes, inotify is not recursive,
+    thus every directory gets its own watch descriptor.
+    '''
+
+    def __init__(self, root, patterns):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify not supported by libc')
+        self._root = root
+        self._patterns = patterns
+        self._wds = dict()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            for dirpath in _watch_dirs(root):
+                self._add_watch(dirpath)
+        except OSError:
+            # e.g. fs.inotify.max_user_watches exhausted
+            self.close()
+            raise
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          IN_WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # vanished in the meantime or no permission, ignore
+                return
+            raise OSError(err, os.strerror(err), path)
+        self._wds[wd] = path
+
+    def _scan_dir(self, dirpath):
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            return set()
+        return {os.path.join(dirpath, name) for name in names
+                if _watch_match(name, self._patterns) and
+                os.path.isfile(os.path.join(dirpath, name))}
+
+    def _watch_new_dir(self, path, changed):
+        for dirpath in _watch_dirs(path):
+            try:
+                self._add_watch(dirpath)
+            except OSError as e:
+                sys.stderr.write(f'builddriver: cannot watch {dirpath}: {e.strerror}, '
+                                 'changes there are not detected\n')
+            # files may be created before the watch is added
+            changed.update(self._scan_dir(dirpath))
+
+    def _process_events(self, buf):
+        changed = set()
+        offset = 0
+        while offset + IN_EVENT_HEADER.size <= len(buf):
+            wd, mask, _, length = IN_EVENT_HEADER.unpack_from(buf, offset)
+            offset += IN_EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events lost, the whole tree must be considered as changed
+                changed.add(self._root)
+                continue
+            if mask & IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+            if wd not in self._wds or not name:
+                continue
+            path = os.path.join(self._wds[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if os.path.basename(path).startswith('.'):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # a new directory is no change on its own
+                    self._watch_new_dir(path, changed)
+                else:
+                    changed.add(path)
+                continue
+            if _watch_match(os.path.basename(path), self._patterns):
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return set()
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            changed = self._process_events(buf)
+            if changed:
+                return changed
+
+    def drain(self) -> Set[str]:
+        # all pending events, without waiting
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            changed |= self._process_events(buf)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class WatchSession:
+    """Rebuild and reparse loop, triggered by source changes.
+
+    Diagnostics are kept across iterations. After each build only
+    the new build output is parsed, warnings and errors of
+    compilation units which were not rebuilt are carried over.
+    A unit counts as rebuilt if its object file next to the source
+    was written by the build. Without such an object file (out of
+    tree builds) a unit counts as rebuilt if it or any header or
+    makefile changed. Diagnostics within headers are dropped when
+    the header changed or all units which included it were rebuilt.
+    Linker errors are always dropped (the link step is redone
+    anyway), errors in general when the build succeeded.
+
+    Note:
+        Start from a clean tree, otherwise make will not report
+        warnings of already built units in the first iteration.
+        Files created by the command do not trigger the next build,
+        changes to files which existed before the build do - this
+        includes edits saved while the command runs.
+    """
+
+    def __init__(self, command: str, path: str = '.', debounce: float = 0.3,
+                 patterns: Iterable[str] = WATCH_PATTERNS, inotify: bool = True,
+                 poll_interval: float = 0.5, **kwargs):
+        # pylint: disable=too-many-arguments
+        self._command = command
+        self._root = os.path.realpath(path)
+        self._debounce = debounce
+        self._kwargs = kwargs
+        self._basedir = os.path.realpath(kwargs.get('cwd') or os.getcwd())
+        self._parser = GccOutputParser()
+        self._handle = None
+        self._iteration = 0
+        self._pending = set()
+        self._watcher = None
+        self._patterns = tuple(patterns)
+        if inotify:
+            try:
+                self._watcher = _InotifyWatcher(self._root, self._patterns)
+            except (OSError, AttributeError):
+                self._watcher = None
+        if self._watcher is None:
+            self._watcher = _PollingWatcher(self._root, self._patterns, poll_interval)
+
+    def _abspath(self, entry, path=None):
+        # relative paths are relative to the directory make
+        # entered, if make told us, else relative to cwd
+        basedir = entry.directory or self._basedir
+        return os.path.realpath(os.path.join(basedir, path or entry.path))
+
+    def _snapshot(self):
+        return _watch_scan(self._root, self._patterns + OBJECT_PATTERNS)
+
+    @staticmethod
+    def _unit_rebuilt(path, state):
+        key = _object_key(path)
+        if key in state.objects:
+            return key in state.rewritten
+        # no object file next to the source, we cannot tell
+        return _is_changed(path, state.changed) or state.build_changed
+
+    def _stale(self, entry, state):
+        if _is_linker_entry(entry):
+            return True
+        abspath = self._abspath(entry)
+        if abspath in state.changed and not os.path.exists(abspath):
+            return True
+        if _watch_match(os.path.basename(entry.path), UNIT_PATTERNS):
+            return abspath in state.reported or self._unit_rebuilt(abspath, state)
+        if _is_changed(abspath, state.changed):
+            return True
+        if not entry.units:
+            # unknown who included it, only a new report replaces it
+            return abspath in state.reported
+        # units rebuilt report it again if still there
+        entry.units = {unit for unit in entry.units
+                       if not self._unit_rebuilt(self._abspath(entry, unit), state)}
+        return not entry.units
+
+    def run_once(self, changed: Optional[Set[str]] = None) -> ExecutionHandle:
+        """Execute the command and merge the diagnostics
+
+        Args:
+            changed: set of changed paths since the last build
+
+        Returns:
+            the ExecutionHandle of this build, the log file of the
+            previous iteration is removed.
+        """
+        state = types.SimpleNamespace()
+        state.changed = {os.path.realpath(path) for path in changed or ()}
+        state.build_changed = any(not _watch_match(os.path.basename(path), UNIT_PATTERNS)
+                                  for path in state.changed)
+        kwargs = dict(self._kwargs)
+        if self._handle is not None:
+            # no need to scan tmp for old logs, we know ours
+            kwargs['precleanup'] = False
+        before = self._snapshot()
+        handle = execute(self._command, **kwargs)
+        after = self._snapshot()
+        # files created by the command are no reason to build again,
+        # but files which existed before were edited meanwhile or
+        # regenerated - build again for them
+        self._pending = {path for path in self._watcher.drain()
+                         if path in before and after.get(path) != before[path]}
+        if self._handle is not None:
+            self._handle.tmp_file_rm()
+        self._handle = handle
+        self._iteration += 1
+        objects = {path: mtime for path, mtime in after.items()
+                   if _watch_match(os.path.basename(path), OBJECT_PATTERNS)}
+        state.objects = {_object_key(path) for path in objects}
+        state.objects.update(_object_key(path) for path in before
+                             if _watch_match(os.path.basename(path), OBJECT_PATTERNS))
+        state.rewritten = {_object_key(path) for path, mtime in objects.items()
+                           if before.get(path) != mtime}
+        entries = list(itertools.chain(handle.errors(), handle.warnings()))
+        state.reported = {self._abspath(entry) for entry in entries}
+        self._parser.discard(lambda entry: self._stale(entry, state))
+        if handle.returncode() == 0:
+            # a successful build has no errors left
+            self._parser.discard(lambda entry: entry.severity == 'error')
+        self._parser.absorb(entries)
+        return handle
+
+    def wait_for_changes(self, timeout: Optional[float] = None) -> Set[str]:
+        """Block until sources changed and no further change
+        happened within the debounce time.
+
+        Returns:
+            set of changed paths, empty if timeout expired
+        """
+        changed = self._pending
+        self._pending = set()
+        if not changed:
+            changed = self._watcher.wait(timeout)
+            if not changed:
+                return changed
+        while True:
+            more = self._watcher.wait(self._debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def loop(self, callback: Optional[Callable] = None,
+             max_iterations: Optional[int] = None) -> None:
+        """Build, wait for changes, rebuild - forever or max_iterations
+        builds. callback(session, handle) is called after every build.
+        """
+        changed = None
+        while True:
+            handle = self.run_once(changed)
+            if callback:
+                callback(self, handle)
+            if max_iterations is not None and self._iteration >= max_iterations:
+                return
+            changed = self.wait_for_changes()
+
+    def iteration(self) -> int:
+        return self._iteration
+
+    def last_handle(self) -> Optional[ExecutionHandle]:
+        return self._handle
+
+    def errors(self) -> Iterator[WarningErrorEntry]:
+        return self._parser.errors()
+
+    def errors_no(self) -> int:
+        return self._parser.errors_no()
+
+    def warnings(self) -> Iterator[WarningErrorEntry]:
+        return self._parser.warnings()
+
+    def warnings_no(self) -> int:
+        return self._parser.warnings_no()
+
+    def close(self):
+        """Stops watching and removes the log of the last build"""
+        self._watcher.close()
+        if self._handle is not None:
+            self._handle.tmp_file_rm()
+
+
+def watch(command: str, path: str = '.', callback: Optional[Callable] = None,
+          max_iterations: Optional[int] = None, **kwargs) -> WatchSession:
+    """Execute command, then re-execute it on every source change below path.
+
+    Args:
+        callback: called as callback(session, handle) after every build
+        max_iterations: stop after n builds, default is to run forever
+        kwargs: passed to WatchSession and execute()
+
+    Returns:
+        the (closed) WatchSession
+    """
+    session = WatchSession(command, path=path, **kwargs)
+    try:
+        session.loop(callback=callback, max_iterations=max_iterations)
+    finally:
+        session.close()
+    return session
+
+
 if __name__ == "__main__":
     sys.stderr.write("Please import this file and use provided function\n")
     sys.exit(1)
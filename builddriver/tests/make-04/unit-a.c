@@ -0,0 +1,4 @@
+int unit_a(int unused)
+{
+	return 0;
+}
@@ -0,0 +1,9 @@
+#include "unit.h"
+
+int unit_a(int unused);
+
+int main(int argc, char **argv)
+{
+	CONSUME(argc, argv);
+	return unit_a(0);
+}
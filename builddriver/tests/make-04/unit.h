@@ -0,0 +1,2 @@
+/* ignores the arguments, thus unused parameter warnings */
+#define CONSUME(a, b)
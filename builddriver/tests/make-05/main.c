@@ -0,0 +1,7 @@
+int missing(void);
+int other(void);
+
+int main(void)
+{
+	return missing() + other();
+}
@@ -0,0 +1,4 @@
+int fs_util(int unused)
+{
+	return 0;
+}
@@ -0,0 +1,6 @@
+#include "y.h"
+
+int main(void)
+{
+	return y(0);
+}
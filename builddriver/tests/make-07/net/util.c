@@ -0,0 +1,6 @@
+#include "../x.h"
+
+int net_util(int unused)
+{
+	return X;
+}
@@ -0,0 +1 @@
+#define X 0
@@ -0,0 +1,4 @@
+static inline int y(int unused)
+{
+	return 0;
+}
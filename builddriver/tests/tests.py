@@ -1,7 +1,12 @@
 import os
 import sys
+import errno
+import shutil
+import tempfile
+import threading
 
 import unittest
+import unittest.mock
 
 import builddriver
 
@@ -120,5 +125,196 @@ class TestLog(unittest.TestCase):
         self.assertTrue(len(ret.log()) > 0)
 
 
+class TestIncrementalParser(unittest.TestCase):
+
+    def test_discard_absorb(self):
+        parser = builddriver.GccOutputParser()
+        parser.record('a.c:1:2: warning: foo\nb.c:3:4: error: bar\n')
+        other = builddriver.GccOutputParser()
+        other.record('a.c:5:6: warning: qux\n')
+        parser.discard(lambda entry: entry.path == 'a.c')
+        self.assertTrue(parser.warnings_no() == 0)
+        self.assertTrue(parser.errors_no() == 1)
+        parser.absorb(other.warnings())
+        self.assertTrue(parser.warnings_no() == 1)
+        self.assertTrue(list(parser.warnings())[0].message == 'qux')
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _session(self, name, inotify=True, make_flags=''):
+        path = os.path.join(self.tmpdir, name)
+        shutil.copytree(os.path.join(FILE_PATH, name), path)
+        session = builddriver.WatchSession(f'make {make_flags} -C {path}', path=path,
+                                           debounce=0.1, inotify=inotify,
+                                           poll_interval=0.05)
+        self.addCleanup(session.close)
+        return session, path
+
+    @staticmethod
+    def _write(path, content):
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    def _rebuild(self, session):
+        changed = session.wait_for_changes(timeout=5)
+        self.assertTrue(len(changed) > 0)
+        return session.run_once(changed)
+
+    @staticmethod
+    def _warning_paths(session):
+        return {warning.path for warning in session.warnings()}
+
+    def _carry_over(self, inotify):
+        session, path = self._session('make-04', inotify=inotify)
+        session.run_once()
+        self.assertTrue(self._warning_paths(session) == {'unit-a.c', 'unit-b.c'})
+        self._write(os.path.join(path, 'unit-a.c'),
+                    'int unit_a(int used)\n{\n\treturn used;\n}\n')
+        changed = session.wait_for_changes(timeout=5)
+        self.assertTrue(os.path.join(path, 'unit-a.c') in changed)
+        handle = session.run_once(changed)
+        # unit-b.c was not rebuilt, but its warnings survive
+        self.assertTrue(handle.warnings_no() == 0)
+        self.assertTrue(self._warning_paths(session) == {'unit-b.c'})
+        self.assertTrue(session.iteration() == 2)
+
+    def test_carry_over_inotify(self):
+        self._carry_over(inotify=True)
+
+    def test_carry_over_polling(self):
+        self._carry_over(inotify=False)
+
+    def test_edit_during_build(self):
+        session, path = self._session('make-04', make_flags='LINK_DELAY=1')
+        # saved while make sleeps in the link step
+        fixed = 'int unit_a(int used)\n{\n\treturn used;\n}\n'
+        timer = threading.Timer(0.5, self._write, (os.path.join(path, 'unit-a.c'), fixed))
+        timer.start()
+        session.run_once()
+        timer.join()
+        self.assertTrue(self._warning_paths(session) == {'unit-a.c', 'unit-b.c'})
+        changed = session.wait_for_changes(timeout=2)
+        self.assertTrue(os.path.join(path, 'unit-a.c') in changed)
+        session.run_once(changed)
+        self.assertTrue(self._warning_paths(session) == {'unit-b.c'})
+
+    def test_header_change(self):
+        session, path = self._session('make-04')
+        session.run_once()
+        self._write(os.path.join(path, 'unit.h'),
+                    '#define CONSUME(a, b) ((void)(a), (void)(b))\n')
+        handle = self._rebuild(session)
+        # unit-b.o is rebuilt without warnings, unit-a.o untouched
+        self.assertTrue(handle.warnings_no() == 0)
+        self.assertTrue(self._warning_paths(session) == {'unit-a.c'})
+
+    def test_same_name_elsewhere(self):
+        session, path = self._session('make-04')
+        session.run_once()
+        os.mkdir(os.path.join(path, 'other'))
+        self._write(os.path.join(path, 'other', 'unit-b.c'), 'int foo;\n')
+        self._rebuild(session)
+        # not the unit-b.c make compiled, nothing to drop
+        self.assertTrue(self._warning_paths(session) == {'unit-a.c', 'unit-b.c'})
+
+    def test_two_headers(self):
+        session, path = self._session('make-07')
+        session.run_once()
+        paths = {'y.h', 'net/util.c', 'fs/util.c'}
+        self.assertTrue(self._warning_paths(session) == paths)
+        # rebuilds net/util.o only, y.h is included by main.c and
+        # fs/util.c just shares the name with net/util.c
+        self._write(os.path.join(path, 'x.h'), '#define X 1\n')
+        self._rebuild(session)
+        self.assertTrue(self._warning_paths(session) == paths)
+        self._write(os.path.join(path, 'y.h'),
+                    'static inline int y(int used)\n{\n\treturn used;\n}\n')
+        self._rebuild(session)
+        self.assertTrue(self._warning_paths(session) == {'net/util.c', 'fs/util.c'})
+
+    def test_errors(self):
+        session, path = self._session('make-05', make_flags='-k')
+        handle = session.run_once()
+        self.assertTrue(handle.returncode() != 0)
+        self.assertTrue(session.errors_no() == 1)
+        self.assertTrue(list(session.errors())[0].path == 'lib.c')
+        # unrelated change, error is still there and not duplicated
+        with open(os.path.join(path, 'main.c'), 'a') as fd:
+            fd.write('\n')
+        self._rebuild(session)
+        self.assertTrue(session.errors_no() == 1)
+        self.assertTrue(list(session.errors())[0].path == 'lib.c')
+        # fixed, but main.c still references a missing symbol
+        self._write(os.path.join(path, 'lib.c'),
+                    'int other(void)\n{\n\treturn 0;\n}\n')
+        handle = self._rebuild(session)
+        self.assertTrue(handle.returncode() != 0)
+        self.assertTrue(session.errors_no() > 0)
+        for error in session.errors():
+            self.assertTrue('undefined reference' in error.message)
+            self.assertTrue(error.path.endswith('main.c'))
+        # symbol provided by lib.c, main.c untouched: linker error is gone
+        with open(os.path.join(path, 'lib.c'), 'a') as fd:
+            fd.write('\nint missing(void)\n{\n\treturn 0;\n}\n')
+        handle = self._rebuild(session)
+        self.assertTrue(handle.returncode() == 0)
+        self.assertTrue(session.errors_no() == 0)
+
+    def test_ignore_build_output(self):
+        session, _ = self._session('make-04')
+        session.run_once()
+        # object files and prog must not trigger a rebuild
+        self.assertTrue(session.wait_for_changes(timeout=0.3) == set())
+
+    def test_ignore_generated_header(self):
+        for inotify in (True, False):
+            session, _ = self._session('make-06', inotify=inotify)
+            self.assertTrue(session.run_once().returncode() == 0)
+            # config.h is written by make, not by the user
+            self.assertTrue(session.wait_for_changes(timeout=0.3) == set())
+            shutil.rmtree(os.path.join(self.tmpdir, 'make-06'))
+
+    def test_inotify_exhausted(self):
+        exhausted = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        with unittest.mock.patch.object(builddriver.builddriver._InotifyWatcher,
+                                        '_add_watch', side_effect=exhausted):
+            session, path = self._session('make-04')
+        # polling fallback still detects changes
+        session.run_once()
+        self._write(os.path.join(path, 'unit-a.c'),
+                    'int unit_a(int used)\n{\n\treturn used;\n}\n')
+        self._rebuild(session)
+        self.assertTrue(self._warning_paths(session) == {'unit-b.c'})
+
+    def test_inotify_add_watch_errno(self):
+        watcher = builddriver.builddriver._InotifyWatcher(self.tmpdir, ('*.c',))
+        self.addCleanup(watcher.close)
+        watcher._libc = unittest.mock.Mock()
+        watcher._libc.inotify_add_watch.return_value = -1
+        with unittest.mock.patch('ctypes.get_errno', return_value=errno.ENOENT):
+            # vanished directory, ignored
+            watcher._add_watch(self.tmpdir)
+        with unittest.mock.patch('ctypes.get_errno', return_value=errno.ENOSPC):
+            with self.assertRaises(OSError):
+                watcher._add_watch(self.tmpdir)
+
+    def test_watch_max_iterations(self):
+        path = os.path.join(self.tmpdir, 'make-04')
+        shutil.copytree(os.path.join(FILE_PATH, 'make-04'), path)
+        builds = list()
+        builddriver.watch(f'make -C {path}', path=path,
+                          max_iterations=1,
+                          callback=lambda session, handle: builds.append(handle))
+        self.assertTrue(len(builds) == 1)
+        self.assertTrue(builds[0].returncode() == 0)
+
+
 if __name__ == '__main__':
     unittest.main()